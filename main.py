@@ -1,13 +1,30 @@
+import asyncio
+import calendar
+import functools
 import json
 import os
 import re
 import sys
+import time
 from datetime import datetime, timedelta
+from operator import itemgetter
+from pathlib import Path
+import aiohttp
 import gspread
 from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+YOUTUBE_API_URL = 'https://www.googleapis.com/youtube/v3'
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=30)
+HTTP_KEEPALIVE_TIMEOUT = 60
+# 同時に送るYouTube APIリクエストの上限（一斉送信による429/403を避ける）
+MAX_CONCURRENT_REQUESTS = 8
+# 一時的なエラーとしてリトライするHTTPステータス
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+_JST_OFFSET = 9 * 3600  # JSTはUTC+9時間（秒）
+# 出力済みのシート名（YYYYMMDD）を記録するローカルマーカー
+DONE_MARKER_PATH = Path.home() / '.cache' / 'youtube_leaf' / 'last_done'
 
 def read_config(file_path):
     """設定ファイル（JSON）からキーワードなどを読み込み、APIキーは環境変数から取得する"""
@@ -33,32 +50,33 @@ def jst_to_utc(jst_str):
 
 def iso8601_to_duration(iso_duration):
     """PT表記（YouTube ISO8601）をHH:MM:SS化"""
-    pattern = re.compile(r'PT(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?')
-    match = pattern.match(iso_duration)
-    if not match:
-        return "00:00:00"
-    hours = int(match.group(1)) if match.group(1) else 0
-    minutes = int(match.group(2)) if match.group(2) else 0
-    seconds = int(match.group(3)) if match.group(3) else 0
-    return str(timedelta(hours=hours, minutes=minutes, seconds=seconds))
+    # 正規表現を使わず1回の走査で数字を読み取り、D/H/M/Sの単位ごとに振り分ける
+    days = hours = minutes = seconds = number = 0
+    for char in iso_duration:
+        if '0' <= char <= '9':
+            number = number * 10 + ord(char) - 48
+        elif char == 'D':
+            days, number = number, 0
+        elif char == 'H':
+            hours, number = number, 0
+        elif char == 'M':
+            minutes, number = number, 0
+        elif char == 'S':
+            seconds, number = number, 0
+    return f"{days * 24 + hours}:{minutes:02d}:{seconds:02d}"
 
 def convert_to_japan_time(utc_time):
     """UTC時刻をJST変換し表示用に"""
-    utc_datetime = datetime.strptime(utc_time, "%Y-%m-%dT%H:%M:%SZ")
-    japan_datetime = utc_datetime + timedelta(hours=9)
-    return japan_datetime.strftime("%Y/%m/%d %H:%M:%S")
+    utc_epoch = calendar.timegm(time.strptime(utc_time, "%Y-%m-%dT%H:%M:%SZ"))
+    return time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(utc_epoch + _JST_OFFSET))
 
 def get_current_japan_time():
     """現在時刻 (JST表示)"""
-    now_utc = datetime.utcnow()
-    now_jst = now_utc + timedelta(hours=9)
-    return now_jst.strftime("%Y/%m/%d %H:%M:%S")
+    return time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(time.time() + _JST_OFFSET))
 
 def get_current_japan_digit_date():
     """今日の日付 (JST, シート名用 'YYYYMMDD' フォーマット)"""
-    now_utc = datetime.utcnow()
-    now_jst = now_utc + timedelta(hours=9)
-    return now_jst.strftime("%Y%m%d")
+    return time.strftime("%Y%m%d", time.gmtime(time.time() + _JST_OFFSET))
 
 def calc_engagement_rate(like_count, comment_count, view_count):
     """エンゲージメント率 (％)"""
@@ -66,92 +84,168 @@ def calc_engagement_rate(like_count, comment_count, view_count):
         return 0.0
     return round((like_count + comment_count) / view_count * 100, 2)
 
-def get_youtube_data(api_key, keyword, start_datetime_jst, end_datetime_jst, max_total_results=100):
+def _is_retryable_error(exception):
+    """レート制限・サーバーエラー・通信エラーならリトライ対象とする"""
+    if isinstance(exception, aiohttp.ClientResponseError):
+        return exception.status in RETRY_STATUS_CODES
+    return isinstance(exception, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+@retry(
+    wait=wait_exponential(multiplier=0.5, max=8),
+    retry=retry_if_exception(_is_retryable_error),
+    stop=stop_after_attempt(5),
+    reraise=True
+)
+async def call_youtube_api(session, semaphore, api_key, resource, **params):
+    """YouTube Data API (REST) を直接呼び出しJSONを返す"""
+    params['key'] = api_key
+    # 同時リクエスト数はセマフォで制限する（空き待ちの時間はリクエストのタイムアウトに含めない）
+    async with semaphore:
+        async with session.get(f"{YOUTUBE_API_URL}/{resource}", params=params) as response:
+            response.raise_for_status()
+            return await response.json()
+
+async def fetch_videos(session, semaphore, api_key, batch_ids, start_utc, end_utc):
+    """videos.listで最大50件分の動画詳細を取得し、期間内のものだけ返す"""
+    video_response = await call_youtube_api(
+        session, semaphore, api_key, 'videos',
+        part='snippet,statistics,contentDetails',
+        id=','.join(batch_ids)
+    )
+
+    video_data = []
+    for item in video_response['items']:
+        snippet = item['snippet']
+        statistics = item.get('statistics', {})
+        content_details = item['contentDetails']
+
+        published_at_utc = snippet['publishedAt']
+
+        # 厳密な時間チェック（YouTube APIのpublishedBefore/Afterは多少曖昧なため）
+        # 同じ書式（YYYY-MM-DDTHH:MM:SSZ）のUTC文字列は辞書順＝時系列順なので、日時に変換せず文字列のまま比較する
+        if not (start_utc <= published_at_utc <= end_utc):
+            continue
+
+        # 'likeCount'や'commentCount'が存在しない場合があるためgetを使用
+        video_data.append({
+            'title': snippet['title'],
+            'channel': snippet['channelTitle'],
+            'published_at': snippet['publishedAt'],
+            'video_id': item['id'],
+            'view_count': int(statistics.get('viewCount', 0)),
+            'like_count': int(statistics.get('likeCount', 0)),
+            'comment_count': int(statistics.get('commentCount', 0)),
+            'duration': content_details.get('duration', "PT0S")
+        })
+
+    return video_data
+
+async def get_youtube_data(session, semaphore, api_key, keyword, start_utc, end_utc, max_total_results=100):
     """
-    指定キーワード・期間のYouTube動画情報を100件上限で取得
+    指定キーワード・期間（UTCのISO8601）のYouTube動画情報を100件上限で取得
     """
-    youtube = build('youtube', 'v3', developerKey=api_key)
-    start_utc = jst_to_utc(start_datetime_jst)
-    end_utc = jst_to_utc(end_datetime_jst)
-    start_dt = datetime.strptime(start_datetime_jst, "%Y-%m-%d %H:%M:%S")
-    end_dt = datetime.strptime(end_datetime_jst, "%Y-%m-%d %H:%M:%S")
-
     video_ids = []
+    dispatched = 0
+    detail_tasks = []
     next_page_token = None
 
-    while len(video_ids) < max_total_results:
-        search_response = youtube.search().list(
-            q=keyword,
-            part='snippet',
-            type='video',
-            maxResults=min(50, max_total_results - len(video_ids)),
-            publishedAfter=start_utc,
-            publishedBefore=end_utc,
-            pageToken=next_page_token
-        ).execute()
-
-        video_ids += [item['id']['videoId'] for item in search_response['items']]
-        next_page_token = search_response.get('nextPageToken')
-        if not next_page_token or len(video_ids) >= max_total_results:
-            break
+    try:
+        while len(video_ids) < max_total_results:
+            requested = min(50, max_total_results - len(video_ids))
+            params = {
+                'q': keyword,
+                'part': 'snippet',
+                'type': 'video',
+                'maxResults': requested,
+                'publishedAfter': start_utc,
+                'publishedBefore': end_utc,
+            }
+            if next_page_token:
+                params['pageToken'] = next_page_token
+            search_response = await call_youtube_api(session, semaphore, api_key, 'search', **params)
 
-    video_data = []
-    for i in range(0, len(video_ids), 50):
-        batch_ids = video_ids[i:i+50]
-        video_response = youtube.videos().list(
-            part='snippet,statistics,contentDetails',
-            id=','.join(batch_ids)
-        ).execute()
-
-        for item in video_response['items']:
-            snippet = item['snippet']
-            statistics = item.get('statistics', {})
-            content_details = item['contentDetails']
-
-            published_at_utc = snippet['publishedAt']
-            published_at_jst = datetime.strptime(published_at_utc, "%Y-%m-%dT%H:%M:%SZ") + timedelta(hours=9)
-
-            # 厳密な時間チェック（YouTube APIのpublishedBefore/Afterは多少曖昧なため）
-            if not (start_dt <= published_at_jst <= end_dt):
-                continue
-
-            # 'likeCount'や'commentCount'が存在しない場合があるためgetを使用
-            video_data.append({
-                'title': snippet['title'],
-                'channel': snippet['channelTitle'],
-                'published_at': snippet['publishedAt'],
-                'video_id': item['id'],
-                'view_count': int(statistics.get('viewCount', 0)),
-                'like_count': int(statistics.get('likeCount', 0)),
-                'comment_count': int(statistics.get('commentCount', 0)),
-                'duration': content_details.get('duration', "PT0S")
-            })
+            items = search_response['items']
+            video_ids.extend(item['id']['videoId'] for item in items)
+            next_page_token = search_response.get('nextPageToken')
+            # search.listは続きがあっても要求件数未満のページを返すことがあるため、件数不足では打ち切らない
+            # 空ページが返った場合のみ、nextPageTokenがあっても続きは無いとみなして打ち切る
+            last_page = not next_page_token or not items or len(video_ids) >= max_total_results
 
-    return video_data
+            # 50件たまった時点（最終ページなら残り全件）で、次ページの検索と並行して詳細取得を開始
+            while len(video_ids) - dispatched >= 50 or (last_page and dispatched < len(video_ids)):
+                batch_ids = video_ids[dispatched:dispatched+50]
+                dispatched += len(batch_ids)
+                detail_tasks.append(asyncio.create_task(fetch_videos(session, semaphore, api_key, batch_ids, start_utc, end_utc)))
+
+            if last_page:
+                break
+
+        results = await asyncio.gather(*detail_tasks)
+    except BaseException:
+        # 検索や詳細取得が失敗した場合、実行中の詳細取得タスクを取り消して終了を待ってから再送出する
+        for task in detail_tasks:
+            task.cancel()
+        await asyncio.gather(*detail_tasks, return_exceptions=True)
+        raise
+    return [video for video_data in results for video in video_data]
 
 def merge_and_deduplicate(video_data_list, keywords):
     """重複削除＋キーワードをタイトルに含む動画のみ抽出"""
+    if not keywords:
+        return []
+    # 全キーワードを1つの正規表現にまとめ、タイトルを1回走査するだけで判定する
+    keyword_pattern = re.compile('|'.join(map(re.escape, keywords)))
+    # 先に動画IDで重複排除し、タイトルチェックは一意な動画につき1回だけ行う
     merged = {}
     for video_data in video_data_list:
         for video in video_data:
-            # キーワードがタイトルに含まれているかチェック
-            if any(k in video['title'] for k in keywords):
-                merged[video['video_id']] = video
-    return list(merged.values())
+            merged.setdefault(video['video_id'], video)
+    # キーワードがタイトルに含まれているかチェック
+    return [video for video in merged.values() if keyword_pattern.search(video['title'])]
+
+@functools.lru_cache(maxsize=1)
+def _get_gspread_client():
+    """サービスアカウント認証済みのgspreadクライアント（1プロセス1回だけ認証）"""
+    # GCP_SERVICE_ACCOUNT_KEYは環境変数/Secretsから取得
+    try:
+        credentials_dict = json.loads(os.environ["GCP_SERVICE_ACCOUNT_KEY"])
+    except KeyError:
+        print("エラー: 環境変数 'GCP_SERVICE_ACCOUNT_KEY' が設定されていません。")
+        sys.exit(1)
+
+    creds = Credentials.from_service_account_info(credentials_dict, scopes=SCOPES)
+    return gspread.authorize(creds)
+
+def is_marked_done(sheet_name):
+    """ローカルマーカーに今日のシート名が記録済みか"""
+    try:
+        return DONE_MARKER_PATH.read_text(encoding='utf-8') == sheet_name
+    except OSError:
+        return False
+
+def mark_done(sheet_name):
+    """今日のシート名をローカルマーカーに記録"""
+    DONE_MARKER_PATH.parent.mkdir(parents=True, exist_ok=True)
+    DONE_MARKER_PATH.write_text(sheet_name, encoding='utf-8')
 
-def export_to_google_sheet(video_data, spreadsheet_id, exec_time_jst, sheet_name):
+def open_spreadsheet_if_sheet_missing(spreadsheet_id, sheet_name):
     """
-    Googleスプレッドシートに出力（新規シート作成しデータ追加）
+    スプレッドシートを開き、今日のシートが未作成ならそのハンドルを返す（作成済みならNone）
     """
-    # サービスアカウント認証 (GCP_SERVICE_ACCOUNT_KEYは環境変数/Secretsから取得)
-    credentials_dict = json.loads(os.environ["GCP_SERVICE_ACCOUNT_KEY"])
-    creds = Credentials.from_service_account_info(credentials_dict, scopes=SCOPES)
-    gc = gspread.authorize(creds)
+    # GCPサービスアカウント認証（スプレッドシートはここで1回だけ開き、出力時にも使い回す）
+    gc = _get_gspread_client()
     sh = gc.open_by_key(spreadsheet_id)
+    # シート名だけをfieldsで指定して取得（グリッド情報などの不要なメタデータは受け取らない）
+    meta = sh.fetch_sheet_metadata(params={'fields': 'sheets(properties(title))'})
+    existing_sheets = {s['properties']['title'] for s in meta['sheets']}
+    if sheet_name in existing_sheets:
+        return None
+    return sh
 
-    # 新しいシートを作成
-    worksheet = sh.add_worksheet(title=sheet_name, rows="100", cols="20")
-
+def export_to_google_sheet(video_data, sh, exec_time_jst, sheet_name):
+    """
+    Googleスプレッドシートに出力（新規シート作成しデータ追加）
+    """
     headers = [
         "動画タイトル", "チャンネル名", "投稿日時（日本時間）", "動画ID",
         "動画URL", "再生回数", "高評価数", "視聴者コメント数", "動画の長さ",
@@ -174,12 +268,22 @@ def export_to_google_sheet(video_data, spreadsheet_id, exec_time_jst, sheet_name
             engagement_rate,
             exec_time_jst
         ])
-    
-    # ヘッダーとデータをシートに追加
-    worksheet.append_row(headers)
-    worksheet.append_rows(rows, value_input_option='USER_ENTERED')
 
-def main():
+    all_rows = [headers]
+    all_rows.extend(rows)
+
+    # 新しいシートを作成（書き込む行数ぶんをあらかじめ確保）
+    sh.add_worksheet(title=sheet_name, rows=str(len(all_rows)), cols="20")
+
+    # ヘッダーとデータを1回の values.batchUpdate でシートに追加
+    # シート名が数字のみ（YYYYMMDD）でもセル参照と誤解されないよう、範囲のシート名は引用符で囲む
+    body = {
+        'valueInputOption': 'USER_ENTERED',
+        'data': [{'range': f"'{sheet_name}'!A1", 'values': all_rows}]
+    }
+    sh.values_batch_update(body)
+
+async def main():
     # 設定ファイル名
     config_file = '動画リストconfig.txt'
     # 自身のスプレッドシートID
@@ -195,29 +299,37 @@ def main():
     # 検索終了日時を今日の10:01:00 JSTに設定
     end_datetime_jst = f"{sheet_name[:4]}-{sheet_name[4:6]}-{sheet_name[6:]} 10:01:00"
 
+    # --- ローカルの完了マーカーチェック（認証含め一切のAPIアクセス前） ---
+    # 手動での再実行時は環境変数 FORCE_RUN=1 でマーカーを無視し、シート存在チェックで判定する
+    if os.environ.get("FORCE_RUN") != "1" and is_marked_done(sheet_name):
+        print(f"✅ {sheet_name}シートは出力済み（ローカル記録あり）のため認証・APIアクセスせずにスキップします。")
+        return
+
     # --- シート存在チェック（APIアクセス前） ---
-    # GCPサービスアカウント認証
-    try:
-        credentials_dict = json.loads(os.environ["GCP_SERVICE_ACCOUNT_KEY"])
-    except KeyError:
-        print("エラー: 環境変数 'GCP_SERVICE_ACCOUNT_KEY' が設定されていません。")
-        sys.exit(1)
-        
-    creds = Credentials.from_service_account_info(credentials_dict, scopes=SCOPES)
-    gc = gspread.authorize(creds)
-    sh = gc.open_by_key(spreadsheet_id)
-    existing_sheets = [ws.title for ws in sh.worksheets()]
-    
-    if sheet_name in existing_sheets:
+    sh = open_spreadsheet_if_sheet_missing(spreadsheet_id, sheet_name)
+    if sh is None:
+        mark_done(sheet_name)
         print(f"✅ {sheet_name}シートは既に存在しているためAPIアクセスせずにスキップします。")
         return
 
     # --- 以降のみYouTube Data APIアクセス ---
-    video_data_list = []
     print(f"➡️ YouTubeデータ取得開始 (キーワード: {len(keywords)}件, 期間: {start_datetime_jst} 〜 {end_datetime_jst})")
-    for keyword in keywords:
-        video_data = get_youtube_data(api_key, keyword, start_datetime_jst, end_datetime_jst, max_total_results=100)
-        video_data_list.append(video_data)
+    # 検索期間のUTC変換は全キーワード共通なので1回だけ行う
+    start_utc = jst_to_utc(start_datetime_jst)
+    end_utc = jst_to_utc(end_datetime_jst)
+
+    # キーワードごとの取得処理を並行実行
+    # search/videosの全リクエストで1つのセッション（コネクションプール）を共有し、TLS接続を使い回す
+    # セマフォはイベントループ上で作成し、各リクエストの送信中だけ枠を占有する（リトライ待機中は解放）
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_REQUESTS, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=HTTP_TIMEOUT) as session:
+        tasks = [
+            asyncio.ensure_future(get_youtube_data(session, semaphore, api_key, keyword, start_utc, end_utc, max_total_results=100))
+            for keyword in keywords
+        ]
+        video_data_list = await asyncio.gather(*tasks)
+    for keyword, video_data in zip(keywords, video_data_list):
         print(f"   - キーワード '{keyword}': {len(video_data)}件取得")
 
     # データ統合、重複排除、タイトルフィルタリング
@@ -225,11 +337,12 @@ def main():
     print(f"➡️ フィルタリング・重複排除後: {len(merged_video_data)}件")
     
     # 再生回数でソート
-    merged_video_data.sort(key=lambda x: x['view_count'], reverse=True)
+    merged_video_data.sort(key=itemgetter('view_count'), reverse=True)
     
     # Googleスプレッドシートに出力
-    export_to_google_sheet(merged_video_data, spreadsheet_id, exec_time_jst, sheet_name)
+    export_to_google_sheet(merged_video_data, sh, exec_time_jst, sheet_name)
+    mark_done(sheet_name)
     print(f"🎉 処理完了（シート名: {sheet_name}、動画数: {len(merged_video_data)}件）")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())